@@ -1,6 +1,19 @@
 import os
+import sys
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import json
-from datetime import datetime, timedelta
+import asyncio
+import re
+import time
+import sqlite3
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 import google.generativeai as genai
 from telegram import Update
@@ -15,10 +28,46 @@ from telegram.ext import (
 # Установите pymorphy2: pip install pymorphy2
 import pymorphy2
 
+# orjson заметно быстрее stdlib json; если не установлен - работаем на json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+HOMEWORK_DB_PATH = os.getenv("HOMEWORK_DB_PATH", "homework.db")
+# Если задан WEBHOOK_URL - работаем через вебхук, иначе long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+LOG_PATH = os.getenv("LOG_PATH", "bot.log")
+# Семантический кэш (нужен sentence-transformers) включается явно: SEMANTIC_CACHE=1
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE") == "1"
+
+logger = logging.getLogger(__name__)
+
+def setup_logging() -> QueueListener:
+    # Хендлеры пишут в очередь, а в файл/stdout пишет отдельный поток -
+    # event loop не блокируется на write().
+    log_queue = queue.SimpleQueue()
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    file_handler = RotatingFileHandler(LOG_PATH, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8")
+    stream_handler = logging.StreamHandler()
+    file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    # httpx пишет каждый запрос на INFO, включая URL с токеном бота
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
 
 def check_env_vars() -> None:
     if not GEMINI_API_KEY:
@@ -32,46 +81,291 @@ check_env_vars()
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel("gemini-2.0-flash")
 
-# Хранилище: { "DD.MM.YYYY": [ {"subject": str, "task": str, "date": str}, ... ] }
-homework_storage = {}
+def parse_ddmmyyyy(date_str: str) -> datetime:
+    # Быстрая замена datetime.strptime(date_str, "%d.%m.%Y"): день и месяц - 1-2 цифры,
+    # год - 4 цифры, без пробелов и знаков
+    parts = date_str.split(".")
+    if (len(parts) != 3
+            or not all(part.isascii() and part.isdigit() for part in parts)
+            or not 1 <= len(parts[0]) <= 2 or not 1 <= len(parts[1]) <= 2 or len(parts[2]) != 4):
+        raise ValueError(f"Неверный формат даты: {date_str!r}")
+    day, month, year = parts
+    return datetime(int(year), int(month), int(day))
+
+def subject_key(subject: str) -> str:
+    # Нормализуем один раз и интернируем: одинаковые ключи - один объект,
+    # сравнение в словарях индекса сводится к сравнению указателей.
+    return sys.intern(subject.lower())
+
+#
+# Хранилище: готовый текст каждой строки + индексы
+# date -> [номера строк] и subject_lc -> [номера строк].
+#
+class HomeworkStorage:
+    def __init__(self) -> None:
+        self.row_reprs = []     # готовый текст строки для ответа
+        self.by_date = {}
+        self.by_subject_lc = {}
+        # Отсортированные даты (date) и параллельно их строки "DD.MM.YYYY"
+        self.sorted_dates = []
+        self.sorted_date_strs = []
+
+    def add(self, subject: str, task: str, date: str) -> None:
+        if date not in self.by_date:
+            self._index_date(date)
+        row = len(self.row_reprs)
+        subject_lc = subject_key(subject)
+        self.row_reprs.append(f"Дата: {date}\nПредмет: {subject}\nЗадание: {task}")
+        self.by_date.setdefault(date, []).append(row)
+        self.by_subject_lc.setdefault(subject_lc, []).append(row)
+
+    def _index_date(self, date: str) -> None:
+        try:
+            day = parse_ddmmyyyy(date).date()
+        except ValueError:
+            return
+        pos = bisect_left(self.sorted_dates, day)
+        self.sorted_dates.insert(pos, day)
+        self.sorted_date_strs.insert(pos, date)
+
+    def dates_from(self, start: date) -> list[str]:
+        # Строки дат >= start в хронологическом порядке
+        return self.sorted_date_strs[bisect_left(self.sorted_dates, start):]
+
+    def format_row(self, row: int) -> str:
+        return self.row_reprs[row]
+
+homework_storage = HomeworkStorage()
+
+#
+# Персистентность: задания пишутся в SQLite и подгружаются в память при старте.
+# Запросы обслуживаются из индексов в памяти, база нужна, чтобы пережить рестарт.
+#
+_db_lock = threading.Lock()
+
+def init_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS hw (date TEXT, subject TEXT, task TEXT)")
+    return conn
+
+def load_homework(conn: sqlite3.Connection, storage: HomeworkStorage) -> None:
+    with _db_lock:
+        rows = conn.execute("SELECT subject, task, date FROM hw ORDER BY rowid").fetchall()
+    for subject, task, date in rows:
+        storage.add(subject, task, date)
+
+def save_homework(conn: sqlite3.Connection, subject: str, task: str, date: str) -> None:
+    # Вызывается через asyncio.to_thread, соединение общее - пишем под замком
+    with _db_lock, conn:
+        conn.execute(
+            "INSERT INTO hw (date, subject, task) VALUES (?, ?, ?)",
+            (date, subject, task),
+        )
+
+db = init_db(HOMEWORK_DB_PATH)
+load_homework(db, homework_storage)
+
+#
+# Кэши ответов LLM: одинаковые фразы ("что задали на завтра?") приходят постоянно,
+# повторный запрос к Gemini для них не нужен.
+#
+class LRUCache:
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+def normalize_text(text: str) -> str:
+    # Нижний регистр + схлопывание пробелов
+    return " ".join(text.lower().split())
+
+_response_cache = LRUCache(maxsize=4096)   # канонический промпт -> JSON ответа
+_parse_cache = LRUCache(maxsize=4096)      # (текст, сегодня) -> результат parse_all
+
+# generate_content блокирующий: выполняем его в потоке, чтобы не стопорить
+# event loop, и ограничиваем число одновременных запросов к Gemini.
+_gemini_sem = asyncio.Semaphore(8)
+
+# Обёртка ```json ... ``` вокруг ответа модели
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+def parse_model_json(text: str):
+    # Чаще всего ответ - чистый JSON, тогда обходимся без лишних проходов по строке
+    # (orjson.JSONDecodeError - подкласс json.JSONDecodeError)
+    try:
+        return _json_loads(text)
+    except json.JSONDecodeError:
+        return _json_loads(_FENCE_RE.sub("", text))
+
+#
+# Пакетная отправка: промпты, пришедшие почти одновременно, склеиваются
+# в один запрос к Gemini, ответ (JSON-массив) раздаётся обратно по future.
+#
+class BatchEngine:
+    def __init__(self, max_batch: int = 8, flush_interval: float = 0.05) -> None:
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._worker = None
+        self._tasks = set()
+
+    async def submit(self, prompt: str):
+        # Очередь и воркер создаём лениво: при импорте event loop ещё не запущен
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # Забираем всё, что уже ждёт в очереди
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # Ждём ещё запросы, только если бот под нагрузкой (есть запросы в полёте);
+            # одиночный промпт уходит сразу, без задержки на flush_interval
+            deadline = loop.time() + self.flush_interval
+            while self._tasks and len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: list) -> None:
+        if len(batch) == 1:
+            (prompt, future), = batch
+            try:
+                self._resolve(future, parse_model_json(await self._generate(prompt)))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        prompts = [prompt for prompt, _ in batch]
+        try:
+            results = parse_model_json(await self._generate(self._compose(prompts)))
+            if not isinstance(results, list) or len(results) != len(prompts):
+                raise ValueError(f"ожидался JSON-массив из {len(prompts)} элементов")
+        except Exception:
+            # Пакетный ответ не сошёлся - не роняем всех, отправляем промпты по одному
+            logger.warning("[BatchEngine] Пакетный ответ не разобран, отправляю %d запросов по одному",
+                           len(batch), exc_info=True)
+            await asyncio.gather(*(self._dispatch([item]) for item in batch))
+            return
+
+        for (_, future), result in zip(batch, results):
+            self._resolve(future, result)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result) -> None:
+        # Каждый элемент ответа должен быть JSON-объектом
+        if future.done():
+            return
+        if isinstance(result, dict):
+            future.set_result(result)
+        else:
+            future.set_exception(ValueError(f"ожидался JSON-объект, получено: {type(result).__name__}"))
+
+    @staticmethod
+    def _compose(prompts: list[str]) -> str:
+        parts = [
+            f"Обработай {len(prompts)} независимых запросов ниже.\n"
+            f"Ответ строго в JSON: массив из {len(prompts)} элементов в том же порядке, "
+            f"каждый элемент - JSON-ответ на соответствующий запрос."
+        ]
+        for i, prompt in enumerate(prompts, 1):
+            parts.append(f"### Запрос {i}\n{prompt.strip()}")
+        return "\n\n".join(parts)
+
+    @staticmethod
+    async def _generate(prompt: str) -> str:
+        async with _gemini_sem:
+            response = await asyncio.to_thread(model.generate_content, prompt)
+        return response.text
+
+_batch_engine = BatchEngine(max_batch=8, flush_interval=0.05)
+_inflight = {}     # канонический промпт -> future с ответом выполняющегося запроса
 
 async def ask_model_for_json(prompt: str) -> dict | None:
+    cache_key = normalize_text(prompt)
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Такой же промпт уже в работе - ждём его ответ, а не шлём второй запрос
+    pending = _inflight.get(cache_key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    pending = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = pending
+    result = None
     try:
-        response = model.generate_content(prompt)
-        json_str = (
-            response.text
-            .replace("```json", "")
-            .replace("```", "")
-            .strip()
-        )
-        return json.loads(json_str)
-    except Exception as e:
-        print(f"[ask_model_for_json] Ошибка парсинга ответа: {e}")
-        return None
+        result = await _batch_engine.submit(prompt)
+        _response_cache.put(cache_key, result)
+    except Exception:
+        logger.exception("[ask_model_for_json] Ошибка парсинга ответа")
+    finally:
+        _inflight.pop(cache_key, None)
+        pending.set_result(result)
+    return result
+
+# Словари pymorphy2 грузятся долго - создаём анализатор один раз
+_MORPH = pymorphy2.MorphAnalyzer()
+
+@lru_cache(maxsize=8192)
+def normal_form(word: str) -> str:
+    # Лемма (именительный падеж, ед. число) для прилагательных и существительных:
+    # "математика", "высший", "английский" и т.д.
+    return _MORPH.parse(word)[0].normal_form
+
+def normalize_subject(subject: str) -> str:
+    # Допустим, предмет может состоять из нескольких слов: "Высшая математика"
+    normalized_parts = [normal_form(w.lower()) for w in subject.split()]
+    # Склеиваем обратно и ставим заглавную букву
+    return " ".join(normalized_parts).capitalize()
 
 #
 # Функция «дочистки» (cleanup): убираем заведомо неверные subject ("задание" и т.п.),
 # и приводим название предмета к именительному падежу через pymorphy2.
+# Падеж нормализуем только при добавлении (normalize=True): в хранилище лежат
+# уже нормализованные названия, запрос сначала сверяется с ними как есть.
 #
-def cleanup_subject_and_date(text: str, subject: str, date_str: str) -> tuple[str, str]:
+def cleanup_subject_and_date(text: str, subject: str, date_str: str,
+                             normalize: bool = True) -> tuple[str, str]:
     # 1) Убираем ошибки
     low_subj = subject.lower().strip()
     if low_subj in ["задание", "задали", "что", "домашнее", "дз"]:
         subject = ""
 
     # 2) Приводим слова предмета к нормальной форме (если subject не пуст)
-    if subject:
-        morph = pymorphy2.MorphAnalyzer()
-        # Допустим, предмет может состоять из нескольких слов: "Высшая математика"
-        subj_parts = subject.split()
-        normalized_parts = []
-        for w in subj_parts:
-            parse = morph.parse(w)[0]
-            # Лемма (именительный падеж, ед. число) для прилагательных и существительных
-            normal_form = parse.normal_form  # "математика", "высший", "английский" и т.д.
-            normalized_parts.append(normal_form)
-        # Склеиваем обратно и ставим заглавную букву
-        subject = " ".join(normalized_parts).capitalize()
+    if subject and normalize:
+        subject = normalize_subject(subject)
 
     # Убираем лишние пробелы у date_str
     date_str = date_str.strip()
@@ -80,100 +374,186 @@ def cleanup_subject_and_date(text: str, subject: str, date_str: str) -> tuple[st
 #
 # Определение интента: add / get
 #
-async def parse_query(text: str) -> str:
-    prompt = f"""
-Определи, относится ли текст к добавлению задания ("add") или запросу заданий ("get").
-Ответ дай строго в JSON виде: {{"intent": ""}}
-
-Текст: {text}
-"""
-    result = await ask_model_for_json(prompt)
-    if not result or "intent" not in result:
-        return "unknown"
-    return result["intent"]
+# Запасной классификатор по ключевым словам: используется, только если
+# модель не вернула интент.
+# Запрос - вопросительная фраза в начале сообщения, а не любое "что ... на" внутри задания
+_GET_RE = re.compile(
+    r"^\W*(что\s+(нам\s+)?(задали|задано|на|по)|какие\s+(задания|дз)|покажи|посмотр(еть|и)\s+(задания|дз))\b",
+    re.I,
+)
+# Явная команда добавить задание
+_ADD_CMD_RE = re.compile(r"\b(добавь(те)?|добавить|запиши(те)?|записать)\b", re.I)
+# Повествовательное "задали ..." / "задания 431, 432"
+_ADD_RE = re.compile(r"\b(задали|задано|задание|задания)\b", re.I)
+
+def classify_intent(text: str) -> str | None:
+    is_get = bool(_GET_RE.search(text))
+    if _ADD_CMD_RE.search(text):
+        return None if is_get else "add"
+    if is_get:
+        return "get"
+    # Вопрос без явных признаков запроса ("задания на завтра?") оставляем модели
+    if _ADD_RE.search(text) and not text.rstrip().endswith("?"):
+        return "add"
+    return None
 
 #
-# Парсинг "добавить задание"
+# Текущая дата для промптов: strftime с %A - поиск по локали, считаем раз в минуту.
+# Заодно промпты в пределах минуты совпадают и попадают в кэш ответов.
 #
-async def parse_homework(text: str) -> dict | None:
-    current_date = datetime.now().strftime("%A, %d.%m.%Y")
+@lru_cache(maxsize=1)
+def _today_key(bucket: int) -> str:
+    return datetime.now().strftime("%A, %d.%m.%Y")
+
+def today_str() -> str:
+    return _today_key(int(time.time()) // 60)
 
-    prompt = f"""
-Проанализируй текст и извлеки три поля:
-1. subject (название предмета). Если не упомянут, ставь "".
+#
+# Разбор сообщения одним запросом к LLM: интент + subject/task/date
+#
+# Неизменяемый кортеж: компактнее dict и можно отдавать из кэша без копирования
+class ParsedMessage(NamedTuple):
+    intent: str
+    subject: str
+    task: str
+    date: str
+
+PARSE_PROMPT_PREFIX = """
+Проанализируй текст и извлеки четыре поля:
+1. intent: "add" - добавление задания, "get" - запрос заданий, иначе "unknown".
+2. subject (название предмета). Если не упомянут, ставь "".
    Не путай слова "задание", "задали" и т.п. с названием предмета.
-2. task (что конкретно задали).
-3. date (DD.MM.YYYY):
-   - Если "завтра"/"послезавтра", вычисли относительно {current_date}.
+3. task (что конкретно задали) - только для "add", иначе "".
+4. date (DD.MM.YYYY):
+   - Если "завтра"/"послезавтра", вычисли относительно текущей даты (указана ниже).
    - Если упомянут день недели, попытайся вычислить ближайшую дату.
    Иначе ставь "".
+Неиспользуемые поля оставляй пустыми.
 
 Ответ строго в JSON:
-{{
+{
+  "intent": "",
   "subject": "",
   "task": "",
   "date": ""
-}}
+}
 
-Текст: {text}
 """
 
-    result = await ask_model_for_json(prompt)
-    if not result:
-        return None
-
-    subject = result.get("subject", "").strip()
-    task = result.get("task", "").strip()
-    date_str = result.get("date", "").strip()
-
-    # "Дочистка": убрать "задание" и т.п. + нормализовать падеж
-    subject, date_str = cleanup_subject_and_date(text, subject, date_str)
-
-    if not (subject or task or date_str):
-        return None
-
-    return {
-        "subject": subject,
-        "task": task,
-        "date": date_str
-    }
-
 #
-# Парсинг "запрос заданий"
+# Семантический кэш: перефразировки ("что на завтра по алгебре?" / "алгебра на завтра?")
+# находим по близости эмбеддингов. Вектор бинаризуется случайными проекциями (LSH)
+# в 64-битную сигнатуру, ищем соседей с расстоянием Хэмминга <= 2 и проверяем косинус.
+# Близость эмбеддингов не различает "завтра"/"послезавтра" или разные предметы,
+# поэтому кандидат принимается, только если совпадают значимые слова текста.
 #
-async def parse_homework_request(text: str) -> dict | None:
-    current_date = datetime.now().strftime("%A, %d.%m.%Y")
-
-    prompt = f"""
-Проанализируй текст и извлеки:
-1. subject (название предмета) - если не упомянут, ставь "".
-   Не путай слова "задание", "задали" и т.п. с названием предмета.
-2. date (дата в формате DD.MM.YYYY) - если не упомянута, ставь "".
-   Если есть "завтра"/"послезавтра"/день недели, вычисли относительно {current_date}.
-
-Ответ строго в JSON:
-{{
-  "subject": "",
-  "date": ""
-}}
+_SEMANTIC_WORD_RE = re.compile(r"\w+")
+# Служебные слова запроса (леммы): от них ответ не зависит, всё остальное -
+# предмет, дата, день недели, номера - должно совпасть точно
+_SEMANTIC_STOP_LEMMAS = frozenset({
+    "что", "какой", "задать", "задание", "дз", "домашний", "домашка",
+    "на", "по", "в", "к", "для", "у", "и", "а", "ли", "есть",
+    "мы", "я", "нам", "показать", "посмотреть", "нужно", "надо",
+})
+
+def _semantic_guard(text: str) -> frozenset:
+    lemmas = (normal_form(w) for w in _SEMANTIC_WORD_RE.findall(text.lower()))
+    return frozenset(lemma for lemma in lemmas if lemma not in _SEMANTIC_STOP_LEMMAS)
+
+class SemanticCache:
+    def __init__(self, encoder, bits: int = 64, max_hamming: int = 2,
+                 threshold: float = 0.9, maxsize: int = 4096) -> None:
+        self.encoder = encoder
+        self.threshold = threshold
+        self._store = LRUCache(maxsize=maxsize)   # (сигнатура, сегодня) -> [(вектор, значимые слова, результат)]
+        dim = encoder.get_sentence_embedding_dimension()
+        self._planes = np.random.default_rng(0).standard_normal((dim, bits)).astype(np.float32)
+        # Маски для перебора соседних сигнатур (0, 1 и 2 отличающихся бита)
+        self._probes = [0] + [1 << i for i in range(bits)]
+        if max_hamming >= 2:
+            self._probes += [(1 << i) | (1 << j) for i in range(bits) for j in range(i + 1, bits)]
+
+    def probe(self, text: str) -> tuple:
+        # Эмбеддинг, LSH-сигнатура и значимые слова текста. Считаются один раз
+        # (в потоке - модель блокирующая) и используются и в lookup, и в put;
+        # сами lookup/put дешёвые и работают в event loop.
+        vec = self.encoder.encode(normalize_text(text), normalize_embeddings=True)
+        bits = (vec @ self._planes) > 0
+        signature = int.from_bytes(np.packbits(bits).tobytes(), "big")
+        return vec, signature, _semantic_guard(text)
+
+    def lookup(self, probe: tuple, current_date: str) -> ParsedMessage | None:
+        vec, signature, guard = probe
+        candidates = (
+            entry
+            for mask in self._probes
+            for entry in self._store.get((signature ^ mask, current_date)) or ()
+        )
+        for cached_vec, cached_guard, parsed in candidates:
+            if cached_guard == guard and float(vec @ cached_vec) > self.threshold:
+                return parsed
+        return None
 
-Текст: {text}
-"""
+    def put(self, probe: tuple, current_date: str, parsed: ParsedMessage) -> None:
+        vec, signature, guard = probe
+        key = (signature, current_date)
+        entries = self._store.get(key) or []
+        entries.append((vec, guard, parsed))
+        self._store.put(key, entries)
+
+if SEMANTIC_CACHE_ENABLED:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    _semantic_cache = SemanticCache(SentenceTransformer("sentence-transformers/paraphrase-MiniLM-L3-v2"))
+else:
+    _semantic_cache = None
+
+async def parse_all(text: str) -> ParsedMessage | None:
+    current_date = today_str()
+
+    # Ключ включает сегодняшнюю дату, чтобы "завтра" не устаревало
+    cache_key = (normalize_text(text), current_date)
+    cached = _parse_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Кэшируем только запросы: у добавления задания важен точный текст,
+    # поэтому явные "добавь"/"задали ..." в семантический кэш не смотрят
+    semantic_probe = None
+    if _semantic_cache is not None and classify_intent(text) != "add":
+        semantic_probe = await asyncio.to_thread(_semantic_cache.probe, text)
+        parsed = _semantic_cache.lookup(semantic_probe, current_date)
+        if parsed is not None:
+            _parse_cache.put(cache_key, parsed)
+            return parsed
+
+    # Постоянный префикс идёт первым и не меняется между вызовами -
+    # так на стороне Gemini может сработать кэш по префиксу промпта.
+    prompt = "".join((PARSE_PROMPT_PREFIX, "Текущая дата: ", current_date, "\n\nТекст: ", text, "\n"))
 
     result = await ask_model_for_json(prompt)
     if not result:
         return None
 
+    # Интент от модели точнее правил; правила - только если модель не определилась
+    intent = result.get("intent", "")
+    if intent not in ("add", "get"):
+        intent = classify_intent(text) or "unknown"
+
     subject = result.get("subject", "").strip()
+    task = result.get("task", "").strip() if intent == "add" else ""
     date_str = result.get("date", "").strip()
 
     # "Дочистка": убрать "задание" и т.п. + нормализовать падеж
-    subject, date_str = cleanup_subject_and_date(text, subject, date_str)
+    subject, date_str = cleanup_subject_and_date(text, subject, date_str, normalize=(intent == "add"))
 
-    return {
-        "subject": subject,
-        "date": date_str
-    }
+    parsed = ParsedMessage(intent, subject, task, date_str)
+    _parse_cache.put(cache_key, parsed)
+    if _semantic_cache is not None and intent == "get":
+        if semantic_probe is None:
+            semantic_probe = await asyncio.to_thread(_semantic_cache.probe, text)
+        _semantic_cache.put(semantic_probe, current_date, parsed)
+    return parsed
 
 #
 # Логика выборки
@@ -186,47 +566,45 @@ def get_tasks_by_filter(subject: str | None, date_str: str | None) -> list[str]:
       - Если есть и subject, и date -> задания для этого предмета и даты.
       - Если нет ни subject, ни date -> все задания.
     """
-    results = []
+    storage = homework_storage
 
     if not subject:
         subject = None
     if not date_str:
         date_str = None
+    subject_lc = subject_key(subject) if subject else None
+    # Ключи в индексе уже нормализованы при добавлении; pymorphy2 нужен,
+    # только если предмет в запросе пришёл в другом падеже ("по математике")
+    if subject_lc and subject_lc not in storage.by_subject_lc:
+        subject_lc = subject_key(normalize_subject(subject))
+
+    # Индексы точные: если даты или предмета в них нет, заданий точно нет
+    if date_str and date_str not in storage.by_date:
+        return []
+    if subject_lc and subject_lc not in storage.by_subject_lc:
+        return []
 
     # 1) есть subject, нет date
     if subject and not date_str:
-        tomorrow = datetime.now() + timedelta(days=1)
-        for d_str, hw_list in homework_storage.items():
-            try:
-                dt = datetime.strptime(d_str, "%d.%m.%Y")
-            except ValueError:
-                continue
-            if dt >= tomorrow:
-                for hw in hw_list:
-                    if hw["subject"].lower() == subject.lower():
-                        results.append(f"Дата: {d_str}\nПредмет: {hw['subject']}\nЗадание: {hw['task']}")
+        subject_rows = set(storage.by_subject_lc[subject_lc])
+        # Сравниваем даты без времени суток, иначе завтрашний день выпадает
+        tomorrow = (datetime.now() + timedelta(days=1)).date()
+        results = []
+        for d_str in storage.dates_from(tomorrow):
+            results.extend(storage.format_row(row) for row in storage.by_date[d_str] if row in subject_rows)
         return results
 
     # 2) есть date, нет subject
     if date_str and not subject:
-        hw_list = homework_storage.get(date_str, [])
-        for hw in hw_list:
-            results.append(f"Дата: {date_str}\nПредмет: {hw['subject']}\nЗадание: {hw['task']}")
-        return results
+        return [storage.format_row(row) for row in storage.by_date[date_str]]
 
     # 3) есть и subject, и date
     if subject and date_str:
-        hw_list = homework_storage.get(date_str, [])
-        for hw in hw_list:
-            if hw["subject"].lower() == subject.lower():
-                results.append(f"Дата: {date_str}\nПредмет: {hw['subject']}\nЗадание: {hw['task']}")
-        return results
+        subject_rows = set(storage.by_subject_lc[subject_lc])
+        return [storage.format_row(row) for row in storage.by_date[date_str] if row in subject_rows]
 
     # 4) нет ни subject, ни date
-    for d_str, hw_list in homework_storage.items():
-        for hw in hw_list:
-            results.append(f"Дата: {d_str}\nПредмет: {hw['subject']}\nЗадание: {hw['task']}")
-    return results
+    return [storage.format_row(row) for rows in storage.by_date.values() for row in rows]
 
 #
 # Telegram-хендлеры
@@ -241,20 +619,30 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_input = update.message.text
-    intent = await parse_query(user_input)
+    parsed = await parse_all(user_input)
+    if parsed is None:
+        await update.message.reply_text("❌ Не удалось распознать сообщение.")
+        return
+
+    intent = parsed.intent
+    subject = parsed.subject
 
     if intent == "add":
-        hw = await parse_homework(user_input)
-        if not hw:
+        task = parsed.task
+        date = parsed.date
+        if not (subject or task or date):
             await update.message.reply_text("❌ Не удалось распознать задание.")
             return
 
-        date = hw["date"]
-        subject = hw["subject"]
-        task = hw["task"]
-
         # Сохраняем
-        homework_storage.setdefault(date, []).append(hw)
+        # Сначала в базу: в памяти не должно быть задания, которое пропадёт при рестарте
+        try:
+            await asyncio.to_thread(save_homework, db, subject, task, date)
+        except sqlite3.Error:
+            logger.exception("[handle_message] Не удалось сохранить задание")
+            await update.message.reply_text("❌ Не удалось сохранить задание, попробуйте ещё раз.")
+            return
+        homework_storage.add(subject, task, date)
 
         await update.message.reply_text(
             f"✅ Задание добавлено:\n"
@@ -263,19 +651,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             f"Задание: {task}"
         )
     elif intent == "get":
-        request_data = await parse_homework_request(user_input)
-        if not request_data:
-            await update.message.reply_text("❌ Не удалось распознать запрос.")
-            return
-
-        subject = request_data["subject"]
-        date_str = request_data["date"]
+        date_str = parsed.date
 
         tasks = get_tasks_by_filter(subject, date_str)
         if tasks:
             await update.message.reply_text("\n\n".join(tasks))
         else:
-            # Формируем текст ошибки
+            # Формируем текст ошибки; предмет в запросе не нормализован ("алгебре"),
+            # для ответа приводим его к каноническому виду
+            if subject:
+                subject = normalize_subject(subject)
             if subject and date_str:
                 await update.message.reply_text(f"❌ Заданий по предмету '{subject}' на {date_str} не найдено.")
             elif subject:
@@ -291,9 +676,33 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # Запуск бота
 #
 if __name__ == "__main__":
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    log_listener = setup_logging()
+
+    # Пул побольше, чтобы параллельные reply_text не ждали свободного соединения
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .connection_pool_size(64)
+        .pool_timeout(5)
+        .get_updates_connection_pool_size(16)
+        # Без этого PTB обрабатывает апдейты строго по одному и пользователи
+        # ждут чужие запросы к Gemini; число совпадает с _gemini_sem
+        .concurrent_updates(8)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    print("Бот запущен...")
-    app.run_polling()
+    logger.info("Бот запущен...")
+    try:
+        if WEBHOOK_URL:
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=WEBHOOK_PORT,
+                url_path=TELEGRAM_BOT_TOKEN,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            )
+        else:
+            app.run_polling()
+    finally:
+        log_listener.stop()